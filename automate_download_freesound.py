@@ -11,10 +11,16 @@ import re
 import glob
 import os
 import time
+import json
 from collections import namedtuple
 import argparse
 import sys
 
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 
 def authenticate():
     '''A function used to retrieve login credentials to authenticate for freesound.org.
@@ -176,67 +182,593 @@ def wait_for_downloads(full_path):
         return True
 
 
-def simulate_download(sound, download_path, user, pass_w, args):
-    '''A function used to automate downloading of sound files via Selenium.
+SearchResult = namedtuple('SearchResult', ['id', 'url'])
+
+DownloadResult = namedtuple('DownloadResult', ['id', 'path', 'bytes', 'elapsed'])
+
+PendingDownload = namedtuple('PendingDownload', ['started', 'last_active', 'existing', 'size'])
+
+
+def search_result_count(driver):
+    '''Read the total number of search results from the current results page.
+
+    :param driver: a chrome driver instance
+    :return: the number of results as an int, or None if it is not shown on the page
+    '''
+    try:
+        content = driver.find_element_by_xpath('//*[@id="content_full"]').text
+    except NoSuchElementException:
+        return None
+    # Only "<n> results" is a result count; "<n> sounds" also appears in pack descriptions
+    match = re.search(r'\b(\d[\d,]*)\s+results?\b', content)
+    if match is None:
+        return None
+    try:
+        return int(match.group(1).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def format_duration(seconds):
+    '''Format a number of seconds as h:mm:ss.
+
+    :param seconds: a number of seconds, or None
+    :return: a string such as 1:02:03, or ? if seconds is None
+    '''
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+
+class Progress(object):
+    '''Download counters for one sound, or for the whole run.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.finished = None
+        self.total = None
+        self.pages = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def snapshot(self, now):
+        '''Summarize the counters along with throughput and estimated time remaining.
+
+        :param now: the current time, from time.time(). Finished progress is summarized as of when it finished.
+        :return: a dictionary that can be serialized to JSON
+        '''
+        if self.finished is not None:
+            now = self.finished
+        elapsed = max(now - self.started, 1e-6)
+        done = self.completed + self.failed
+        eta = None
+        if self.total is not None and done:
+            eta = max(self.total - done, 0) * elapsed / done
+        return {'name': self.name,
+                'total': self.total,
+                'pages': self.pages,
+                'queued': self.queued,
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'failed': self.failed,
+                'bytes': self.bytes,
+                'finished': self.finished,
+                'elapsed': elapsed,
+                'bytes_per_sec': self.bytes / elapsed,
+                'eta': eta}
+
+
+class ProgressReporter(object):
+    '''Track progress per sound and overall, and report it to a terminal and/or a JSON status file.
+
+    Counters are updated on every event, but output is only written every interval seconds,
+    so reporting adds next to nothing to the download loop.
+    '''
+
+    def __init__(self, stream=None, status_file=None, interval=1.0, sounds=None):
+        '''
+        :param stream: a file object to draw a live status line on, e.g. sys.stderr (None to disable)
+        :param status_file: a path to rewrite with a JSON status every interval (None to disable)
+        :param interval: minimum number of seconds between reports
+        :param sounds: the number of sounds in the run. The overall total, and so the overall ETA,
+            is only known once every sound's result count is (None if unknown)
+        '''
+        self.stream = stream
+        self.status_file = status_file
+        self.interval = interval
+        self.sounds = sounds
+        self.overall = Progress(None)
+        self.current = None
+        self.finished = []
+        self.known_totals = []
+        self.last_report = 0
+        self.last_line_length = 0
+
+    def start_sound(self, sound):
+        '''Begin tracking a new sound.
+
+        :param sound: a string of the sound being downloaded
+        '''
+        self.current = Progress(sound)
+        self.report()
+
+    def finish_sound(self):
+        '''Write a final report for the current sound and stop tracking it.'''
+        self.current.finished = time.time()
+        self.report()
+        self.finished.append(self.current)
+        self.current = None
+        self.last_line_length = 0
+        if self.stream is not None:
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def set_total(self, total):
+        '''Record the total number of search results for the current sound.
+
+        :param total: the number of results, or None if unknown
+        '''
+        if total is None or self.current is None:
+            return
+        self.current.total = total
+        self.known_totals.append(total)
+        if self.sounds is not None and len(self.known_totals) == self.sounds:
+            self.overall.total = sum(self.known_totals)
+
+    def page_crawled(self, queued):
+        '''Record a crawled results page.
+
+        :param queued: the number of sound files found on the page
+        '''
+        for progress in self.tracked():
+            progress.pages += 1
+            progress.queued += queued
+        self.maybe_report()
+
+    def download_started(self):
+        '''Record a download that was started.'''
+        for progress in self.tracked():
+            progress.queued = max(progress.queued - 1, 0)
+            progress.in_flight += 1
+        self.maybe_report()
+
+    def download_finished(self, size):
+        '''Record a download that finished.
+
+        :param size: the size of the downloaded file in bytes
+        '''
+        for progress in self.tracked():
+            progress.in_flight -= 1
+            progress.completed += 1
+            progress.bytes += size
+        self.maybe_report()
+
+    def download_failed(self):
+        '''Record a download that was given up on.'''
+        for progress in self.tracked():
+            progress.in_flight -= 1
+            progress.failed += 1
+        self.maybe_report()
+
+    def tracked(self):
+        '''
+        :return: a list of the Progress counters to update, for the current sound and overall
+        '''
+        if self.current is None:
+            return [self.overall]
+        return [self.current, self.overall]
+
+    def clear_line(self):
+        '''Blank out the live status line, so other output is not printed into the middle of it.
+        It is drawn again on the next report.
+        '''
+        if self.stream is not None and self.last_line_length:
+            self.stream.write("\r" + " " * self.last_line_length + "\r")
+            self.stream.flush()
+            self.last_line_length = 0
+
+    def message(self, text):
+        '''Print a message without garbling the live status line.
+
+        :param text: the message to print
+        '''
+        self.clear_line()
+        print(text)
+        self.maybe_report()
+
+    def maybe_report(self):
+        '''Report progress, unless the last report was less than interval seconds ago.'''
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        '''Write the current progress to the stream and status file.'''
+        now = time.time()
+        self.last_report = now
+        overall = self.overall.snapshot(now)
+        current = self.current.snapshot(now) if self.current is not None else None
+        if self.stream is not None and current is not None:
+            line = ("%s: %d pages, %d/%s done, %d in flight, %d queued, %.1f KB/s, ETA %s "
+                    "| overall %d done, ETA %s" %
+                    (current['name'], current['pages'], current['completed'],
+                     current['total'] if current['total'] is not None else "?",
+                     current['in_flight'], current['queued'], current['bytes_per_sec'] / 1024,
+                     format_duration(current['eta']), overall['completed'],
+                     format_duration(overall['eta'])))
+            # Pad with spaces to blank out the rest of a longer previous line
+            self.stream.write("\r" + line.ljust(self.last_line_length))
+            self.stream.flush()
+            self.last_line_length = len(line)
+        if self.status_file is not None:
+            status = {'updated': now,
+                      'current': current,
+                      'sounds': [progress.snapshot(now) for progress in self.finished],
+                      'overall': overall}
+            # Write to a temporary file first, so readers never see a half written status
+            tmp_file = self.status_file + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(status, f)
+            if os.path.exists(self.status_file) and os.name == 'nt':
+                os.remove(self.status_file)
+            os.rename(tmp_file, self.status_file)
+
+
+def driver_rss(driver):
+    '''Measure the memory used by a chrome driver instance. This is the total
+    resident set size of the chromedriver process and every browser process it launched.
+
+    :param driver: a chrome driver instance
+    :return: resident memory in bytes
+    '''
+    process = psutil.Process(driver.service.process.pid)
+    total = 0
+    for proc in [process] + process.children(recursive=True):
+        try:
+            total += proc.memory_info().rss
+        except psutil.NoSuchProcess:
+            # Browser processes come and go as tabs and renderers are recycled
+            pass
+    return total
+
+
+def sound_id_from_url(url):
+    '''Extract the numeric freesound ID from a sound page URL.
+
+    :param url: a sound page URL, e.g. https://freesound.org/people/<user>/sounds/<id>/
+    :return: the sound ID as a string, or None if the URL is not a sound page
+    '''
+    match = re.search(r'/sounds/(\d+)', url)
+    if match:
+        return match.group(1)
+    return None
+
+
+def find_downloads(full_path, sound_id):
+    '''List the files of a given sound in full_path, finished or still downloading.
+    Freesound names downloaded files "<id>__<user>__<name>.<ext>".
+
+    :param full_path: the absolute path to the folder where audio files are downloaded
+    :param sound_id: the freesound ID of the sound
+    :return: a set of paths
+    '''
+    return set(glob.glob(os.path.join(full_path, sound_id + "__*")))
+
+
+def find_finished_download(full_path, sound_id, existing=()):
+    '''Look for a completed download of a given sound in full_path.
+
+    :param full_path: the absolute path to the folder where audio files are downloaded
+    :param sound_id: the freesound ID of the sound
+    :param existing: paths that were there before the download started, e.g. from an earlier run
+    :return: the path of the finished file, or None if it is missing or still downloading
+    '''
+    for path in sorted(find_downloads(full_path, sound_id) - set(existing)):
+        if not path.endswith(".crdownload"):
+            return path
+    return None
+
+
+def filters_from_args(args):
+    '''Build a search filters dictionary from parsed command line arguments.
 
-    :param sound: a string of the desired sound to download
-    :param download_path: a path of the desired download path
     :param args: a Namespace object with attributes such as file format, sample rate, and advanced filtering
-    :return: count of number of downloads
+    :return: a dictionary with samplerate, file_format and advanced_filter keys
     '''
-    full_path = os.path.join(download_path, sound)
+    return {'samplerate': args.samplerate,
+            'file_format': args.file_format,
+            'advanced_filter': args.advanced_filter}
 
-    if not os.path.exists(full_path):
-        # make a directory for the files to go to
-        os.makedirs(full_path)
 
-    download_count = 0
-    driver = setup(full_path)
-    search_subject = sound
-    try:
+class FreesoundClient(object):
+    '''A programmatic interface to search and download sound files from freesound.org.
+
+    The client owns a single chrome driver that downloads into full_path. Use it as a
+    context manager so the browser is closed when done:
 
-        driver = login(driver, user, pass_w)
+        with FreesoundClient(full_path, user, pass_w) as client:
+            for result in client.download(client.iter_search("dogs", {'file_format': 'wav'})):
+                print(result.path)
+    '''
 
-        driver = enter_search_subject(driver, search_subject)
-        if args.samplerate is not None:
-            driver = filter_by_attribute(driver, 'samplerate', args.samplerate)
-        if args.file_format is not None:
-            driver = filter_by_attribute(driver, 'fileformat', args.file_format)
+    def __init__(self, full_path, user, pass_w, poll_interval=1, max_pages=None, max_rss_mb=None,
+                 progress=None, download_timeout=300):
+        '''
+        :param full_path: absolute path to download to
+        :param user: the user's email login
+        :param pass_w: the user's password
+        :param poll_interval: seconds to wait between checks for finished downloads
+        :param max_pages: relaunch the browser after it has loaded this many pages (None for no limit)
+        :param max_rss_mb: relaunch the browser once it uses this many megabytes of memory (None for no limit)
+        :param progress: an optional ProgressReporter to notify of pages crawled and downloads
+        :param download_timeout: seconds to wait for a download that shows no activity before giving up on it
+        :raises ImportError: if max_rss_mb is given but psutil is not installed
+        '''
+        if max_rss_mb is not None and psutil is None:
+            raise ImportError("psutil is required to limit the browser's memory usage.")
+        self.full_path = full_path
+        self.user = user
+        self.pass_w = pass_w
+        self.poll_interval = poll_interval
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.progress = progress
+        self.download_timeout = download_timeout
+        # Downloads started but not finished, by sound ID, and results not yet handed out
+        self.pending = {}
+        self.ready = []
+        self.driver = None
+        self.page_count = 0
+        self.recycle_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        '''Launch the chrome driver and log into freesound.org, if not done already.
+
+        :return: the chrome driver instance
+        '''
+        if self.driver is None:
+            if not os.path.exists(self.full_path):
+                # make a directory for the files to go to
+                os.makedirs(self.full_path)
+            self.driver = login(setup(self.full_path), self.user, self.pass_w)
+            # Give slow pages a moment to render before element lookups fail
+            self.driver.implicitly_wait(1)
+            self.page_count = 1
+        return self.driver
+
+    def close(self):
+        '''Close all open browsers associated with the driver instance.'''
+        if self.driver is not None:
+            self.driver.quit()
+            self.driver = None
+
+    def needs_recycle(self):
+        '''Check whether the driver has crossed its page count or memory limit.
+
+        :return: a boolean value, True if the browser should be relaunched
+        '''
+        if self.driver is None:
+            return False
+        if self.max_pages is not None and self.page_count >= self.max_pages:
+            return True
+        if self.max_rss_mb is not None and driver_rss(self.driver) >= self.max_rss_mb * 1024 * 1024:
+            return True
+        return False
 
-        if args.advanced_filter:
+    def recycle(self):
+        '''Quit the browser and launch a fresh, logged in one. Pending downloads are allowed
+        to finish (or time out) first, as quitting the browser would cancel them.
+
+        :return: the new chrome driver instance
+        '''
+        self.poll_downloads()
+        while self.pending:
+            time.sleep(self.poll_interval)
+            self.poll_downloads()
+        self.close()
+        self.recycle_count += 1
+        return self.open()
+
+    def get(self, url):
+        '''Load a page, relaunching the browser first if it has crossed its limits.
+
+        :param url: the URL to load
+        :return: the chrome driver instance
+        '''
+        if self.needs_recycle():
+            self.recycle()
+        driver = self.open()
+        driver.get(url)
+        self.page_count += 1
+        return driver
+
+    def iter_search(self, query, filters=None):
+        '''Search freesound.org and yield every result, page by page.
+
+        :param query: a string containing the desired sound
+        :param filters: an optional dictionary with samplerate, file_format and advanced_filter keys
+        :return: a generator of SearchResult namedtuples with id and url attributes
+        '''
+        filters = filters or {}
+        driver = enter_search_subject(self.open(), query)
+        self.page_count += 1
+        if self.progress is not None:
+            # Filtering may print a message about unsupported values
+            self.progress.clear_line()
+        if filters.get('samplerate') is not None:
+            driver = filter_by_attribute(driver, 'samplerate', filters['samplerate'])
+        if filters.get('file_format') is not None:
+            driver = filter_by_attribute(driver, 'fileformat', filters['file_format'])
+        if filters.get('advanced_filter'):
             # Advanced search for only search subject in tags or file name
             driver = advanced_filtering(driver)
-        driver.implicitly_wait(1)
+        if self.progress is not None:
+            self.progress.set_total(search_result_count(driver))
 
         while True:
-            # Gather all links on the page
-            links = driver.find_elements_by_class_name("title")
-            # Loop through all links on this page to download
-            for j in range(len(links)):
-
-                links[j].send_keys(Keys.RETURN)
-
-                # Finding the download button
-                download_link = driver.find_element_by_xpath('//*[@id="download_button"]')
-                download_link.send_keys(Keys.RETURN)
-                download_count += 1
-                driver.back()
-                # Redefine links to avoid stale element error
-                links = driver.find_elements_by_class_name("title")
-            if not find_next_page(driver):
+            page_url = self.driver.current_url
+            if self.needs_recycle():
+                # Filters are part of the search URL, so the new browser resumes at this page
+                self.recycle()
+                self.get(page_url)
+            # Gather all links on the page before handing them out, as the
+            # caller may navigate away from this page between results
+            links = self.driver.find_elements_by_class_name("title")
+            urls = [link.get_attribute("href") for link in links]
+            results = [SearchResult(id=sound_id_from_url(url), url=url) for url in urls
+                       if sound_id_from_url(url) is not None]
+            if self.progress is not None:
+                self.progress.page_crawled(len(results))
+            for result in results:
+                yield result
+            if self.driver.current_url != page_url:
+                self.get(page_url)
+            if not find_next_page(self.driver):
                 break
+            self.page_count += 1
+
+    def download(self, items):
+        '''Download sound files and yield each one as soon as it has finished.
+
+        :param items: an iterable of SearchResult namedtuples, e.g. from iter_search()
+        :return: a generator of DownloadResult namedtuples with id, path, bytes and elapsed attributes.
+            Downloads that never finish within download_timeout are yielded with a path of None.
+        '''
+        seen = set()
+        for item in items:
+            if item.id in seen:
+                # Results can shift between pages while crawling, so a sound may be listed twice
+                continue
+            seen.add(item.id)
+            driver = self.get(item.url)
+            # Remember files of this sound from earlier runs, so they are not mistaken for this download
+            existing = find_downloads(self.full_path, item.id)
+            # Finding the download button
+            download_link = driver.find_element_by_xpath('//*[@id="download_button"]')
+            download_link.send_keys(Keys.RETURN)
+            now = time.time()
+            self.pending[item.id] = PendingDownload(started=now, last_active=now, existing=existing, size=0)
+            if self.progress is not None:
+                self.progress.download_started()
+            self.poll_downloads()
+            for result in self._take_ready():
+                yield result
 
         # Wait for the rest of the downloads to finish
-        while not wait_for_downloads(full_path):
-            time.sleep(5)
+        while self.pending:
+            time.sleep(self.poll_interval)
+            self.poll_downloads()
+            for result in self._take_ready():
+                yield result
+        # Downloads finished while recycling the browser
+        for result in self._take_ready():
+            yield result
+
+    def _take_ready(self):
+        '''
+        :return: a list of the DownloadResult namedtuples not handed out yet
+        '''
+        results, self.ready = self.ready, []
+        return results
+
+    def poll_downloads(self):
+        '''Move finished downloads from pending to ready.
+
+        A download that has not grown for download_timeout seconds, e.g. because chrome
+        cancelled, blocked or stalled it, is given up on and made ready with a path of None.
+        '''
+        pending = self.pending
+        results = self.ready
+        now = time.time()
+        for sound_id, download in list(pending.items()):
+            new_files = find_downloads(self.full_path, sound_id) - download.existing
+            path = find_finished_download(self.full_path, sound_id, download.existing)
+            if path is not None:
+                del pending[sound_id]
+                results.append(DownloadResult(id=sound_id,
+                                              path=path,
+                                              bytes=os.path.getsize(path),
+                                              elapsed=now - download.started))
+                if self.progress is not None:
+                    self.progress.download_finished(results[-1].bytes)
+                continue
+            size = 0
+            for new_file in new_files:
+                try:
+                    size += os.path.getsize(new_file)
+                except OSError:
+                    # Chrome renamed the file as it finished; it is picked up on the next poll
+                    pass
+            if size > download.size:
+                # Still downloading
+                pending[sound_id] = download._replace(last_active=now, size=size)
+            elif self.download_timeout is not None and now - download.last_active >= self.download_timeout:
+                del pending[sound_id]
+                self._message("Download of sound %s did not finish... Skipping it." % sound_id)
+                results.append(DownloadResult(id=sound_id,
+                                              path=None,
+                                              bytes=0,
+                                              elapsed=now - download.started))
+                if self.progress is not None:
+                    self.progress.download_failed()
+        if self.progress is not None:
+            # Keep the throughput and ETA current while nothing finishes
+            self.progress.maybe_report()
+
+    def _message(self, text):
+        '''Print a message, through the progress reporter if there is one.
+
+        :param text: the message to print
+        '''
+        if self.progress is not None:
+            self.progress.message(text)
+        else:
+            print(text)
+
+
+def simulate_download(sound, download_path, user, pass_w, args, progress=None):
+    '''A function used to automate downloading of sound files via Selenium.
 
-        # Close all open browsers associated with driver instance and garbage collect driver instance
-        driver.quit()
+    :param sound: a string of the desired sound to download
+    :param download_path: a path of the desired download path
+    :param args: a Namespace object with attributes such as file format, sample rate, and advanced filtering
+    :param progress: an optional ProgressReporter to report this sound's progress to
+    :return: count of number of downloads
+    '''
+    full_path = os.path.join(download_path, sound)
+
+    download_count = 0
+    if progress is not None:
+        progress.start_sound(sound)
+    try:
+        with FreesoundClient(full_path, user, pass_w,
+                             max_pages=args.max_driver_pages,
+                             max_rss_mb=args.max_driver_memory,
+                             progress=progress) as client:
+            items = client.iter_search(sound, filters_from_args(args))
+            for result in client.download(items):
+                if result.path is not None:
+                    download_count += 1
 
     except TimeoutException:
+        if progress is not None:
+            progress.clear_line()
         print("Time out exception... Page took too long to load...")
         sys.exit(1)
 
+    if progress is not None:
+        progress.finish_sound()
     return download_count
 
 
@@ -305,6 +837,29 @@ def parse_args(argv):
                              'Only audio files with tags, filenames, and descriptions '
                              'containing your search item will be downloaded.')
 
+    parser.add_argument('--max-driver-pages',
+                        dest='max_driver_pages',
+                        type=int,
+                        default=None,
+                        help='Relaunch the browser after it has loaded this many pages, '
+                             'to keep memory bounded on long runs. '
+                             'Default will be no limit.')
+
+    parser.add_argument('--max-driver-memory',
+                        dest='max_driver_memory',
+                        type=int,
+                        default=None,
+                        help='Relaunch the browser once it uses this many megabytes of memory. '
+                             'Requires psutil to be installed. '
+                             'Default will be no limit.')
+
+    parser.add_argument('--status-file',
+                        dest='status_file',
+                        default=None,
+                        help='Optional path to a JSON file that is kept up to date with download progress '
+                             '(pages crawled, files queued, in flight and completed, bytes/sec and ETA). '
+                             'A live status line is always shown when running in a terminal.')
+
     # If no arguments provided, return help message
     if len(argv) == 1:
         parser.print_help(sys.stderr)
@@ -320,6 +875,10 @@ def main(argv):
     sounds = args.sounds
     download_path = args.downloadpath
 
+    if args.max_driver_memory is not None and psutil is None:
+        print("Limiting browser memory requires psutil. Please run pip install psutil. Exiting program...")
+        sys.exit(1)
+
     if not os.path.exists(download_path):
         print("The download destination directory specified does not exist... Defaulting to Downloads folder.")
         download_path = os.path.expanduser("~") + "/Downloads/"
@@ -331,8 +890,14 @@ def main(argv):
         print("The credentials you entered were not correct. Please re-run the script. Exiting program...")
         sys.exit(1)
 
+    progress = None
+    stream = sys.stderr if sys.stderr.isatty() else None
+    if stream is not None or args.status_file is not None:
+        progress = ProgressReporter(stream=stream, status_file=args.status_file, sounds=len(sounds))
+
     for elem in sounds:
-        download_count = simulate_download(elem, download_path, user_info.email, user_info.password, args)
+        download_count = simulate_download(elem, download_path, user_info.email, user_info.password, args,
+                                           progress=progress)
         output_path = os.path.join(download_path, elem)
         print("Downloaded %d files of \"%s\" at %s" %
               (download_count, elem, output_path))
@@ -16,6 +16,11 @@ from collections import namedtuple
 import pytest
 import os
 import shutil
+import tempfile
+import json
+import re
+import time
+import threading
 
 
 class FreeSoundLoginElementsTest(unittest.TestCase):
@@ -359,6 +364,12 @@ class CommandLineArgumentsTests(unittest.TestCase):
                 ['automate_download_freesound.py', "dogs,cats,birds,", "--sample-rate", "2500"])
         self.assertEqual(err.exception.code, 2)
 
+    def test_parse_args_driver_limits(self):
+        args = automate_download_freesound.parse_args(
+            ['automate_download_freesound.py', "dogs", "--max-driver-pages", "200", "--max-driver-memory", "1024"])
+        self.assertEqual(args.max_driver_pages, 200)
+        self.assertEqual(args.max_driver_memory, 1024)
+
     def test_parse_args_download_path_pass(self):
         args = automate_download_freesound.parse_args(
             ['automate_download_freesound.py', "dogs,cats,birds,"])
@@ -371,3 +382,407 @@ class CommandLineArgumentsTests(unittest.TestCase):
         with self.assertRaises(SystemExit) as err:
             automate_download_freesound.main(['automate_download_freesound.py'])
         self.assertEqual(err.exception.code, 1)
+
+
+class FakeElement(object):
+    '''A stand-in for a web element that runs on_return when RETURN is sent to it.'''
+
+    def __init__(self, on_return=None, href=None, text=''):
+        self.on_return = on_return
+        self.href = href
+        self.text = text
+
+    def send_keys(self, keys):
+        if keys == automate_download_freesound.Keys.RETURN and self.on_return is not None:
+            self.on_return()
+
+    def get_attribute(self, name):
+        return self.href
+
+
+class FakeBrowser(object):
+    '''A stand-in for a chrome driver serving search result pages and sound pages.
+    Pressing a sound's download button writes "<id>__someone__sound.wav" to full_path.
+
+    :param pages: a list of result pages, each a list of link URLs
+    :param full_path: the folder downloads are written to
+    '''
+    search_url = 'https://freesound.org/search/?q=dogs'
+
+    def __init__(self, pages, full_path):
+        self.pages = pages
+        self.full_path = full_path
+        self.current_url = None
+        self.visited = []
+        self.implicit_wait = None
+        self.quit = mock.MagicMock()
+
+    def get(self, url):
+        self.current_url = url
+        self.visited.append(url)
+
+    def implicitly_wait(self, seconds):
+        self.implicit_wait = seconds
+
+    def page_number(self):
+        match = re.search(r'&page=(\d+)$', self.current_url or '')
+        return int(match.group(1)) if match else None
+
+    def go_to_page(self, number):
+        self.current_url = re.sub(r'&page=\d+$', '', self.current_url) + '&page=%d' % number
+
+    def add_filter(self, value):
+        self.current_url = re.sub(r'&page=\d+$', '', self.current_url) + '&f=%s&page=1' % value
+
+    def download(self):
+        self.save(automate_download_freesound.sound_id_from_url(self.current_url))
+
+    def save(self, sound_id):
+        with open(os.path.join(self.full_path, sound_id + '__someone__sound.wav'), 'w') as f:
+            f.write('x' * int(sound_id))
+
+    def find_element_by_xpath(self, xpath):
+        if xpath == '//*[@id="search"]/form/fieldset/input[1]':
+            return FakeElement(lambda: self.get(self.search_url + '&page=1'))
+        if xpath == '//*[@id="content_full"]/div[2]/ul/li[2]/a' and self.page_number() < len(self.pages):
+            return FakeElement(lambda: self.go_to_page(self.page_number() + 1))
+        if xpath == '//*[@id="download_button"]':
+            return FakeElement(self.download)
+        raise NoSuchElementException()
+
+    def find_element_by_link_text(self, text):
+        return FakeElement(lambda: self.add_filter(text))
+
+    def find_elements_by_class_name(self, name):
+        if self.page_number() is None:
+            return []
+        return [FakeElement(href=href) for href in self.pages[self.page_number() - 1]]
+
+
+class SlowFakeBrowser(FakeBrowser):
+    '''A FakeBrowser whose downloads only appear on disk a moment after the click.'''
+
+    def download(self):
+        sound_id = automate_download_freesound.sound_id_from_url(self.current_url)
+        threading.Timer(0.05, self.save, [sound_id]).start()
+
+
+class FreesoundClientTest(unittest.TestCase):
+
+    sound_url = 'https://freesound.org/people/someone/sounds/%d/'
+
+    def setUp(self):
+        self.full_path = tempfile.mkdtemp()
+        self.driver = FakeBrowser([[self.sound_url % 10, self.sound_url % 20]], self.full_path)
+        self.client = automate_download_freesound.FreesoundClient(
+            self.full_path, 'example@gmail.com', 'MyPassword', poll_interval=0)
+        self.client.driver = self.driver
+
+    def tearDown(self):
+        shutil.rmtree(self.full_path, ignore_errors=True)
+
+    def test_sound_id_from_url(self):
+        self.assertEqual(automate_download_freesound.sound_id_from_url(
+            'https://freesound.org/people/someone/sounds/12345/'), '12345')
+        self.assertIsNone(automate_download_freesound.sound_id_from_url('https://freesound.org/search/'))
+
+    def test_find_finished_download(self):
+        open(os.path.join(self.full_path, '123__someone__bark.wav'), 'w').close()
+        open(os.path.join(self.full_path, '456__someone__meow.wav.crdownload'), 'w').close()
+        self.assertEqual(automate_download_freesound.find_finished_download(self.full_path, '123'),
+                         os.path.join(self.full_path, '123__someone__bark.wav'))
+        self.assertIsNone(automate_download_freesound.find_finished_download(self.full_path, '456'))
+        self.assertIsNone(automate_download_freesound.find_finished_download(self.full_path, '12'))
+        existing = [os.path.join(self.full_path, '123__someone__bark.wav')]
+        self.assertIsNone(automate_download_freesound.find_finished_download(self.full_path, '123', existing))
+
+    def test_download_yields_results(self):
+        '''
+        Test that download() yields one result per finished file with its size
+        '''
+        items = [automate_download_freesound.SearchResult(id='10', url=self.sound_url % 10),
+                 automate_download_freesound.SearchResult(id='20', url=self.sound_url % 20)]
+        results = list(self.client.download(items))
+        self.assertEqual([result.id for result in results], ['10', '20'])
+        self.assertEqual([result.bytes for result in results], [10, 20])
+        self.assertTrue(all(result.elapsed >= 0 for result in results))
+
+    def test_download_ignores_existing_files(self):
+        '''
+        Test that a file left over from an earlier run is not mistaken for the new download
+        '''
+        old_path = os.path.join(self.full_path, '10__someone__old.wav')
+        open(old_path, 'w').close()
+        results = list(self.client.download(
+            [automate_download_freesound.SearchResult(id='10', url=self.sound_url % 10)]))
+        self.assertEqual(results[0].path, os.path.join(self.full_path, '10__someone__sound.wav'))
+        self.assertEqual(results[0].bytes, 10)
+
+    def test_download_timeout(self):
+        '''
+        Test that a download which never shows up is reported with no path instead of waiting forever
+        '''
+        self.client.download_timeout = 0
+        self.driver.download = lambda: None
+        results = list(self.client.download(
+            [automate_download_freesound.SearchResult(id='10', url=self.sound_url % 10)]))
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0].path)
+        self.assertEqual(results[0].bytes, 0)
+
+    def test_download_stalled(self):
+        '''
+        Test that a partial download which stops growing is given up on
+        '''
+        def stalled_download():
+            with open(os.path.join(self.full_path, '7__someone__sound.wav.crdownload'), 'w') as f:
+                f.write('x' * 7)
+        self.client.download_timeout = 0.2
+        self.client.poll_interval = 0.05
+        self.driver.download = stalled_download
+        started = time.time()
+        results = list(self.client.download(
+            [automate_download_freesound.SearchResult(id='7', url=self.sound_url % 7)]))
+        self.assertIsNone(results[0].path)
+        self.assertLess(time.time() - started, 2)
+
+    def test_download_skips_duplicates(self):
+        '''
+        Test that a sound listed twice is only downloaded and reported once
+        '''
+        item = automate_download_freesound.SearchResult(id='10', url=self.sound_url % 10)
+        self.client.download_timeout = 0
+        results = list(self.client.download([item, item]))
+        self.assertEqual([result.id for result in results], ['10'])
+        self.assertIsNotNone(results[0].path)
+        self.assertEqual(self.driver.visited, [self.sound_url % 10])
+
+    def test_poll_downloads_reports_progress(self):
+        '''
+        Test that progress keeps being reported while waiting on downloads that have not finished
+        '''
+        self.client.progress = mock.MagicMock()
+        now = time.time()
+        self.client.pending['10'] = automate_download_freesound.PendingDownload(
+            started=now, last_active=now, existing=set(), size=0)
+        self.client.poll_downloads()
+        self.assertIn('10', self.client.pending)
+        self.client.progress.maybe_report.assert_called_once_with()
+        self.assertFalse(self.client.progress.download_finished.called)
+
+    def test_iter_search(self):
+        '''
+        Test crawling two filtered result pages while download() navigates away between results
+        '''
+        self.driver.pages = [[self.sound_url % 1, 'https://freesound.org/people/someone/', self.sound_url % 2],
+                             [self.sound_url % 3]]
+        items = self.client.iter_search('dogs', {'file_format': 'wav', 'samplerate': None})
+        results = list(self.client.download(items))
+        self.assertEqual([result.id for result in results], ['1', '2', '3'])
+        page_one = FakeBrowser.search_url + '&f=wav&page=1'
+        self.assertEqual(self.driver.visited,
+                         ['https://freesound.org', FakeBrowser.search_url + '&page=1',
+                          self.sound_url % 1, self.sound_url % 2, page_one, self.sound_url % 3,
+                          FakeBrowser.search_url + '&f=wav&page=2'])
+
+    def test_close(self):
+        self.client.close()
+        self.driver.quit.assert_called_once_with()
+        self.assertIsNone(self.client.driver)
+
+    def test_needs_recycle_page_limit(self):
+        self.client.max_pages = 3
+        self.client.page_count = 2
+        self.assertFalse(self.client.needs_recycle())
+        self.client.page_count = 3
+        self.assertTrue(self.client.needs_recycle())
+
+    @mock.patch('automate_download_freesound.driver_rss')
+    def test_needs_recycle_memory_limit(self, driver_rss):
+        self.client.max_rss_mb = 512
+        driver_rss.return_value = 100 * 1024 * 1024
+        self.assertFalse(self.client.needs_recycle())
+        driver_rss.return_value = 600 * 1024 * 1024
+        self.assertTrue(self.client.needs_recycle())
+
+    @mock.patch('automate_download_freesound.setup')
+    @mock.patch('automate_download_freesound.login')
+    def test_get_recycles_driver(self, login, setup):
+        '''
+        Test that crossing the page limit relaunches and logs into a new browser before loading a page
+        '''
+        new_driver = mock.MagicMock()
+        login.return_value = new_driver
+        self.client.max_pages = 2
+        self.client.page_count = 2
+        driver = self.client.get('https://freesound.org/search/?q=dogs&page=4')
+        self.driver.quit.assert_called_once_with()
+        login.assert_called_once_with(setup.return_value, 'example@gmail.com', 'MyPassword')
+        new_driver.get.assert_called_once_with('https://freesound.org/search/?q=dogs&page=4')
+        self.assertIs(driver, new_driver)
+        self.assertEqual(self.client.recycle_count, 1)
+        self.assertEqual(self.client.page_count, 2)
+        new_driver.implicitly_wait.assert_called_once_with(1)
+
+    @mock.patch('automate_download_freesound.setup')
+    @mock.patch('automate_download_freesound.login')
+    def test_iter_search_recycles_driver(self, login, setup):
+        '''
+        Test that crossing the page limit partway through a crawl resumes at the same results page
+        '''
+        pages = [[self.sound_url % 1, self.sound_url % 2], [self.sound_url % 3], [self.sound_url % 4]]
+        self.driver.pages = pages
+        new_driver = FakeBrowser(pages, self.full_path)
+        login.return_value = new_driver
+        self.client.max_pages = 3
+        ids = [result.id for result in self.client.iter_search('dogs')]
+        self.assertEqual(ids, ['1', '2', '3', '4'])
+        self.driver.quit.assert_called_once_with()
+        self.assertEqual(self.client.recycle_count, 1)
+        self.assertEqual(new_driver.visited, [FakeBrowser.search_url + '&page=3'])
+        self.assertEqual(new_driver.implicit_wait, 1)
+
+    @mock.patch('automate_download_freesound.setup')
+    @mock.patch('automate_download_freesound.login')
+    def test_recycle_waits_for_pending_downloads(self, login, setup):
+        '''
+        Test that downloads clicked just before a recycle finish instead of being cancelled
+        '''
+        pages = [[self.sound_url % 1, self.sound_url % 2, self.sound_url % 3]]
+        self.driver = SlowFakeBrowser(pages, self.full_path)
+        self.client.driver = self.driver
+        new_driver = SlowFakeBrowser(pages, self.full_path)
+        login.return_value = new_driver
+        self.client.max_pages = 3
+        self.client.poll_interval = 0.01
+        self.client.download_timeout = 2
+
+        def quit():
+            # Quitting chrome cancels whatever has not been written yet
+            self.assertEqual(sorted(os.listdir(self.full_path)),
+                             ['1__someone__sound.wav', '2__someone__sound.wav'])
+        self.driver.quit.side_effect = quit
+        results = list(self.client.download(self.client.iter_search('dogs')))
+        self.assertEqual(self.client.recycle_count, 1)
+        self.assertEqual(sorted((result.id, result.path is not None) for result in results),
+                         [('1', True), ('2', True), ('3', True)])
+
+
+class ProgressReporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.status_file = os.path.join(self.tmp_dir, 'status.json')
+        self.stream = mock.MagicMock()
+        self.reporter = automate_download_freesound.ProgressReporter(
+            stream=self.stream, status_file=self.status_file, interval=0, sounds=1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_format_duration(self):
+        self.assertEqual(automate_download_freesound.format_duration(3723), '1:02:03')
+        self.assertEqual(automate_download_freesound.format_duration(None), '?')
+
+    def test_search_result_count(self):
+        driver = mock.MagicMock()
+        driver.find_element_by_xpath.return_value.text = 'dogs\n1,234 results\n'
+        self.assertEqual(automate_download_freesound.search_result_count(driver), 1234)
+        driver.find_element_by_xpath.return_value.text = 'Dog barking, sounds recorded in a pack of 12 sounds'
+        self.assertIsNone(automate_download_freesound.search_result_count(driver))
+        driver.find_element_by_xpath.side_effect = NoSuchElementException()
+        self.assertIsNone(automate_download_freesound.search_result_count(driver))
+
+    def test_progress_counters(self):
+        '''
+        Test that queued, in flight and completed counts follow the download events
+        '''
+        self.reporter.start_sound('dogs')
+        self.reporter.set_total(10)
+        self.reporter.page_crawled(3)
+        self.reporter.download_started()
+        self.reporter.download_started()
+        self.reporter.download_finished(2048)
+        for progress in (self.reporter.current, self.reporter.overall):
+            self.assertEqual(progress.total, 10)
+            self.assertEqual(progress.pages, 1)
+            self.assertEqual(progress.queued, 1)
+            self.assertEqual(progress.in_flight, 1)
+            self.assertEqual(progress.completed, 1)
+            self.assertEqual(progress.bytes, 2048)
+
+    def test_progress_eta(self):
+        progress = automate_download_freesound.Progress('dogs')
+        progress.total = 10
+        progress.completed = 2
+        progress.bytes = 200
+        snapshot = progress.snapshot(progress.started + 4)
+        self.assertAlmostEqual(snapshot['eta'], 16)
+        self.assertAlmostEqual(snapshot['bytes_per_sec'], 50)
+
+    def test_status_file(self):
+        self.reporter.start_sound('dogs')
+        self.reporter.page_crawled(15)
+        self.reporter.finish_sound()
+        self.reporter.start_sound('cats')
+        with open(self.status_file) as f:
+            status = json.load(f)
+        self.assertEqual(status['current']['name'], 'cats')
+        self.assertEqual([sound['name'] for sound in status['sounds']], ['dogs'])
+        self.assertEqual(status['overall']['queued'], 15)
+        self.assertTrue(self.stream.write.called)
+
+    def test_report_throttled(self):
+        reporter = automate_download_freesound.ProgressReporter(stream=self.stream, interval=3600)
+        reporter.start_sound('dogs')
+        self.stream.reset_mock()
+        reporter.page_crawled(15)
+        reporter.download_started()
+        self.assertFalse(self.stream.write.called)
+
+    def test_finished_sound_snapshot(self):
+        '''
+        Test that a finished sound's figures stay as they were when it finished
+        '''
+        progress = automate_download_freesound.Progress('dogs')
+        progress.bytes = 200
+        progress.finished = progress.started + 4
+        snapshot = progress.snapshot(progress.started + 100)
+        self.assertAlmostEqual(snapshot['elapsed'], 4)
+        self.assertAlmostEqual(snapshot['bytes_per_sec'], 50)
+
+    def test_overall_total_needs_every_sound(self):
+        '''
+        Test that the overall total (and ETA) is only known once every sound's result count is
+        '''
+        reporter = automate_download_freesound.ProgressReporter(sounds=2)
+        reporter.start_sound('dogs')
+        reporter.set_total(10)
+        self.assertIsNone(reporter.overall.total)
+        reporter.finish_sound()
+        reporter.start_sound('cats')
+        reporter.set_total(5)
+        self.assertEqual(reporter.overall.total, 15)
+
+    def test_status_line_cleared(self):
+        '''
+        Test that a shorter status line blanks out the end of the previous one
+        '''
+        self.reporter.start_sound('a much longer sound name')
+        self.reporter.current.name = 'dogs'
+        self.reporter.report()
+        lines = [call[0][0] for call in self.stream.write.call_args_list]
+        self.assertEqual(len(lines[-1]), len(lines[-2]))
+        self.assertTrue(lines[-1].rstrip().endswith('ETA ?'))
+
+    @mock.patch('sys.stdout')
+    def test_message_clears_status_line(self, stdout):
+        '''
+        Test that a message blanks out the status line before it is printed
+        '''
+        self.reporter.start_sound('dogs')
+        line_length = len(self.stream.write.call_args[0][0]) - 1
+        self.stream.reset_mock()
+        self.reporter.message('Skipping it.')
+        self.assertEqual(self.stream.write.call_args_list[0][0][0], '\r' + ' ' * line_length + '\r')
+        self.assertTrue(stdout.write.called)